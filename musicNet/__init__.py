@@ -82,14 +82,22 @@ Contents
 # Authorization on databases doesn't appear to work with .create().
 
 import os
+import re
+import errno
 import sys
 import time
 import random
-import weakref
+import socket
 import threading
+import Queue
 import unittest, doctest
 import json
-import sqlite3
+import hashlib
+import inspect
+import heapq
+import itertools
+import pkgutil
+import collections
 import py2neo
 import py2neo.neo4j
 import music21
@@ -129,89 +137,114 @@ def addMomentsToScore(score, forceAdd=False):
         if el.__class__.__name__ == 'Moment':
             if forceAdd:
                 break
-            sys.stderr.write('This score already has Moments. ',
+            sys.stderr.write('This score already has Moments. '
                              'Use the forceAdd=True argument to override.\n')
             return
 
-    attackLookup = {}
+    attackLookup = collections.defaultdict(set)
     addNotesFromStream(attackLookup, score, 0)    
-    attackOffsets = attackLookup.keys()
-    attackOffsets.sort()
-    
-    import heapq
-    releaseOffsets = []
-    releaseLookup = {}
-    for offset in attackOffsets:
+    # group the onsets by tick, so offsets that differ only by rounding share a moment
+    attacksByTick = {}
+    for offset in attackLookup:
+        attacksByTick.setdefault(_ticks(offset), []).append(offset)
+    
+    releases = []  # a heap of (release tick, attack order, note) tuples
+    attackOrder = itertools.count()
+    sustained = set()
+    for tick in sorted(attacksByTick):
+        offsets = attacksByTick[tick]
+        offset = min(offsets)
+        if len(offsets) == 1:
+            notes = attackLookup[offset]
+        else:
+            notes = set().union(*[attackLookup[x] for x in offsets])
         moment = Moment()
         # drop any sustained notes that have passed
-        while (releaseOffsets and releaseOffsets[0] <= offset):
-            del releaseLookup[releaseOffsets[0]]
-            heapq.heappop(releaseOffsets)  # always returns the lowest element
-        # add any current sustained notes to the moment
-        for r in releaseOffsets:
-            for n in releaseLookup[r]:
-                moment.addComponents(n, sameOffset=False)
-        # add any new onsets to the moment
+        while releases and releases[0][0] <= tick:
+            sustained.discard(heapq.heappop(releases)[2])
+        # add any current sustained notes and new onsets to the moment
+        # (these are all Notes already, so addComponents' checks can be skipped)
+        moment.simultaneous.update(sustained)
+        moment.sameOffset.update(notes)
         # add a release reference for every note
-        notes = attackLookup[offset]
         for note in notes:
-            moment.addComponents(note, sameOffset=True)
-            noteReleaseOffset = offset + note.quarterLength
-            if (noteReleaseOffset not in releaseOffsets):
-                heapq.heappush(releaseOffsets, noteReleaseOffset)
-                releaseLookup[noteReleaseOffset] = weakref.WeakSet()
-            releaseLookup[noteReleaseOffset].add(note)
+            noteReleaseTick = _ticks(offset + note.quarterLength)
+            heapq.heappush(releases, (noteReleaseTick, next(attackOrder), note))
+            sustained.add(note)
         score.insert(offset, moment)
 
 def addNotesFromStream(attackLookup, obj, offset):
-    try:
-        classes = obj._classes
-    except AttributeError:
-        return
-    if classes == None:
-        return
-    offset += obj.offset
-    if 'Stream' in classes:
-        for el in obj:
-            addNotesFromStream(attackLookup, el, offset)
-        return
-    if 'Note' not in classes:
-        return
-    # Add a reference to the Note indexed by offset
-    try:
-        attackLookup[offset].add(obj)
-    except KeyError:
-        attackLookup[offset] = weakref.WeakSet([obj])
+    '''Adds every Note in `obj` to the `attackLookup` dict, indexed by 
+    absolute offset. The lookup must be a `defaultdict(set)`.
+    '''
+    pending = collections.deque([(obj, offset)])
+    while pending:
+        obj, offset = pending.popleft()
+        classes = getattr(obj, '_classes', None)
+        if classes is None:
+            continue
+        offset += obj.offset
+        if 'Stream' in classes:
+            pending.extend((el, offset) for el in obj)
+        elif 'Note' in classes:
+            # Add a reference to the Note indexed by offset
+            attackLookup[offset].add(obj)
+
+# Offsets are compared in whole ticks, so that float rounding (e.g. in triplets)
+# doesn't make equal offsets look different.
+_TICKS_PER_QUARTER = 96
+
+def _ticks(offset):
+    return int(round(offset * _TICKS_PER_QUARTER))
 
 def _signedModulo(val, mod):
     ''' This modulo function will return both negative and positive numbers.
+    The result has the same sign as `val`.
+    
+    >>> _signedModulo(14, 12)
+    2
+    >>> _signedModulo(-14, 12)
+    -2
     '''
-    if val == 0:
-        return 0
-    sign = val / abs(val)
-    while abs(val) >= mod:
-        val -= mod * sign
-    return val
+    if val < 0:
+        return -(-val % mod)
+    return val % mod
+
+_DEFAULT_URI = 'http://localhost:7474/db/data/'
 
 class Results(threading.Thread):
     
-    def __init__(self, queryText, params=None):
+    def __init__(self, queryText, params=None, db=None):
         threading.Thread.__init__(self)
         py2neo.packages.httpstream.http.ConnectionPool._puddles = {}
         self.queryText = queryText
         self.params = params
-        self.results = []
+        self.db = db
+        self.results = collections.deque()
+        self.error = None  # sys.exc_info() of a failed query
         
     def run(self):
-        db = Database()
-        query = py2neo.neo4j.CypherQuery(db.graph_db, self.queryText)
-        if self.params:
-            p = self.params
-            self.stream = query.stream(**p) 
-        else:
-            self.stream = query.stream()
-        for item in self.stream:
-            self.results.append(item)
+        try:
+            # Only a connection is needed, not a whole Database object.
+            if self.db is None:
+                graph_db = py2neo.neo4j.GraphDatabaseService(_DEFAULT_URI)
+            else:
+                graph_db = py2neo.neo4j.GraphDatabaseService(self.db.uri, **self.db.dbargs)
+            query = py2neo.neo4j.CypherQuery(graph_db, self.queryText)
+            if self.params:
+                p = self.params
+                self.stream = query.stream(**p) 
+            else:
+                self.stream = query.stream()
+            for item in self.stream:
+                self.results.append(item)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def _raiseError(self):
+        # Re-raise a query failure in the caller's thread.
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
 
     def next(self, limit=10):
         output = []
@@ -222,15 +255,27 @@ class Results(threading.Thread):
                 else:
                     break
             if self.results:
-                output.append(self.results.pop(0))
+                output.append(self.results.popleft())
             else:
                 break
         return output
     
+    def __iter__(self):
+        ''' Yields the results as they arrive, without waiting for the query to finish.
+        '''
+        while True:
+            rows = self.next(100)
+            if not rows:
+                self._raiseError()
+                return
+            for row in rows:
+                yield row
+
     def fetch_all(self):
         while self.is_alive():
             time.sleep(0.1)
-        return self.results
+        self._raiseError()
+        return list(self.results)
     
     def stop(self):
         self.stream.close()
@@ -243,38 +288,146 @@ def _getPy2neoMetadata(node):
     # 1.4: return node._Resource__metadata['data'] # 1.4
     return node.__dict__['_properties']
 
+_STRING_CONSTANTS = { 'None': None, 'True': True, 'False': False }
+# Filter values that are shown in quotes when a Filter is printed.
+_TEXT_TYPES = (str, unicode, bool)
+_INTEGER_RE = re.compile(r'[-+]?\d+$')
+_FLOAT_RE = re.compile(r'[-+]?(\d+\.\d*|\.\d+)([eE][-+]?\d+)?$')
+_OCTAVE_RE = re.compile(r'[0-9]+')
+
+# Property values repeat a lot ('True', '1', '0.5'...), so conversions are remembered.
+_convertedStrings = {}
+_UNCONVERTED = object()
+
 def _convertFromString(val):
-    if not isinstance(val, (str, unicode)):
+    if not isinstance(val, basestring):
         return val
-    if val == 'None':
-        val = None
-    elif val == 'True':
-        val = True
-    elif val == 'False':
-        val = False
+    converted = _convertedStrings.get(val, _UNCONVERTED)
+    if converted is not _UNCONVERTED:
+        return converted
+    if val in _STRING_CONSTANTS:
+        converted = _STRING_CONSTANTS[val]
+    elif _INTEGER_RE.match(val):
+        converted = int(val)
+    elif _FLOAT_RE.match(val):
+        converted = float(val)
     else:
-        if val.find('.') >= 0:
-            try:
-                val = float(val)
-            except ValueError: pass
-        else:
-            try:
-                val = int(val)
-            except ValueError: pass
-    return val
+        # Don't remember other strings: the cache would return a str for a unicode value.
+        return val
+    if len(_convertedStrings) > 10000:
+        _convertedStrings.clear()
+    _convertedStrings[val] = converted
+    return converted
+
+# Parent types that don't get a quarterLength from their Duration.
+_UNTIMED_TYPES = frozenset(('StaffGroup', 'Instrument', 'Metadata'))
+
+# Converters from the JSON stored in the schema cache back to the types
+# used by the Database.list* methods.
+_SCHEMA_DECODERS = {
+    'rTypes': list,
+    'nTypes': set,
+    'nodeProperties': lambda rows: [tuple(x) for x in rows],
+    'nodePropertyValues': lambda rows: [(t, p, tuple(v)) for t, p, v in rows],
+    'relateProperties': lambda rows: [tuple(x) for x in rows],
+    'relatePropertyValues': lambda rows: [(t, p, tuple(v)) for t, p, v in rows],
+}
+
+_music21Classes = {}
+
+def _getMusic21Classes():
+    ''' Returns a dict of the classes in the loaded music21 modules, indexed by name.
+    The dict is built on first use and rebuilt by :func:`_music21Class` when a
+    name is missing, in case more music21 modules have been imported since.
+    '''
+    if not _music21Classes:
+        for importer, modname, ispkg in pkgutil.iter_modules(music21.__path__):
+            modname = 'music21.' + modname
+            if modname not in sys.modules:
+                continue
+            mod = sys.modules[modname]
+            for c in inspect.getmembers(mod, inspect.isclass):
+                _music21Classes[c[0]] = getattr(mod, c[0])
+    return _music21Classes
+
+def _music21Class(name):
+    ''' Returns the music21 class with the given name.
+    '''
+    classes = _getMusic21Classes()
+    if name not in classes:
+        # A music21 module may have been imported after the dict was built.
+        _music21Classes.clear()
+        classes = _getMusic21Classes()
+    try:
+        return classes[name]
+    except KeyError:
+        raise KeyError('No music21 class named "%s" has been loaded.' % name)
+
+def _frozen(value):
+    ''' Returns a hashable copy of a filter value, such as a list from a JSON query.
+    '''
+    if isinstance(value, (list, tuple)):
+        return tuple(_frozen(x) for x in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _frozen(v)) for k, v in value.iteritems()))
+    return value
 
 # return the ID of a py2neo object
 def _id(item):
     return item._id  # __dict__['_id']
 
-def _serverCall(func, *args):
-    while True:
-#       try:
-        r = func(*args)
-#        except py2neo.rest.SocketError:
-#            time.sleep(0.2)
-#            continue
-        return r
+_SERVER_RETRIES = 5
+_SERVER_MAX_DELAY = 5.0  # seconds
+
+def _serverCall(func, *args, **keywords):
+    ''' Calls a py2neo function, retrying with exponential backoff if the
+    connection to the server fails. Calls made with `idempotent=False` may 
+    have been applied even when the response is lost, so they are only retried 
+    if the connection was refused outright.
+    '''
+    idempotent = keywords.get('idempotent', True)
+    delay = 0.2
+    for attempt in range(_SERVER_RETRIES):
+        try:
+            return func(*args)
+        except (py2neo.packages.httpstream.http.SocketError, socket.error) as e:
+            refused = getattr(e, 'errno', None) == errno.ECONNREFUSED
+            if attempt == _SERVER_RETRIES - 1 or not (idempotent or refused):
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, _SERVER_MAX_DELAY)
+
+# Request Timeout and Request Entity Too Large: the batch was never applied.
+_SPLIT_STATUS_CODES = (408, 413)
+
+def _createEntities(graph_db, items):
+    ''' Creates nodes and relationships in the database with the batch API.
+    '''
+    return graph_db.create(*items)
+
+def _createNodes(graph_db, vertices):
+    ''' Creates a node for each dict of properties in `vertices` with a single
+    parameterized Cypher statement, and returns the nodes in the same order.
+    '''
+    props = [dict((k, v) for k, v in vertex.iteritems() if v is not None) 
+             for vertex in vertices]
+    query = py2neo.neo4j.CypherQuery(graph_db, 'CREATE (n {props}) RETURN n')
+    return [row.values[0] for row in query.execute(props=props).data]
+
+def _createSplitting(graph_db, items, create=_createEntities):
+    ''' Creates `items` in the database with a single request. If the server 
+    rejects the request as too large or timed out, the items are split in half 
+    and each half is tried again. Results are returned in the order of `items`.
+    '''
+    try:
+        return _serverCall(create, graph_db, items, idempotent=False)
+    except py2neo.packages.httpstream.http.ClientError as e:
+        if (getattr(e, 'status_code', None) not in _SPLIT_STATUS_CODES or
+                len(items) < 2):
+            raise
+    half = len(items) // 2
+    return (_createSplitting(graph_db, items[:half], create) + 
+            _createSplitting(graph_db, items[half:], create))
 
 def _fix535(results, metadata):
     orderColumn = -1
@@ -287,111 +440,132 @@ def _fix535(results, metadata):
         for i in range(len(results)):
             results[i].pop(orderColumn)
 
+class _HideFromDatabase(object):
+    ''' The type of :attr:`Database.HIDEFROMDATABASE`, a unique value returned by
+    property callbacks, so that it can be checked by identity.
+    '''
+    def __repr__(self):
+        return 'HIDEFROMDATABASE'
+
 class NodeFarm():
+    '''Scratch storage for the nodes and relationships extracted from a score
+    before they are written to the database. Each table is kept as a set of
+    parallel column lists, and rows are numbered from 1 in the order they were added.
+    Vertices and relationship properties are stored as snapshots, so later changes
+    to a caller's dict only reach the table through :meth:`updateNode`.
+    '''
     
     def __init__(self):
-        sqlite3.register_converter("JSON", json.loads)
-        # self.dbFile = './musicnet_import_%d.db' % os.getpid()
-        self.sqldb = sqlite3.connect('', detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-        self.sqldb.row_factory = sqlite3.Row
-        c = self.sqldb.cursor()
-        # c.execute('DROP TABLE IF EXISTS nodeLookup;')
-        c.execute('CREATE TABLE nodeLookup (hash INTEGER, parentHash INTEGER, vertex JSON, nodeRef INTEGER);')
-        # c.execute('DROP TABLE IF EXISTS edges;')
-        c.execute('CREATE TABLE edges (startNodeHash INTEGER, relationship TEXT, endNodeHash INTEGER, properties JSON);')
-        c.execute('CREATE INDEX nodeLookup_hash_IDX on nodeLookup (hash);')
-        self.sqldb.commit()
-        self.writeBuffer = []
-        
-    def flushBuffer(self):
-        if len(self.writeBuffer) == 0:
-            return
-        c = self.sqldb.cursor()
-        for command in self.writeBuffer:
-            c.execute(*command)
-        self.sqldb.commit()
-        self.writeBuffer = []
-    
+        # nodes
+        self.nodeHashes = []
+        self.parentHashes = []
+        self.vertices = []
+        self.hashRows = {}  # hash -> list of row indexes with that hash
+        # relationships
+        self.edgeStarts = []
+        self.edgeRelationships = []
+        self.edgeEnds = []
+        self.edgeProperties = []
+        self._hashCache = {}
+        
+    def _hash(self, obj):
+        ''' Returns the lookup hash of an object, computing it only once per object.
+        Integers are assumed to be hashes already and are passed through.
+        '''
+        if isinstance(obj, int):
+            return obj
+        cached = self._hashCache.get(id(obj))
+        if cached is None:
+            # Keep a reference to the object so that its id can't be reused.
+            cached = self._hashCache[id(obj)] = (hash(obj), obj)
+        return cached[0]
+
+    def _nodeRow(self, idx):
+        return { 'hash': self.nodeHashes[idx],
+                 'parentHash': self.parentHashes[idx],
+                 'vertex': self.vertices[idx] }
+
     def addNode(self, obj, parent, vertex=None):
-        if len(self.writeBuffer) > 1000:
-            self.flushBuffer()
         parentHash = parent
-        if parent and not isinstance(parent, int):
-            parentHash = hash(parent)
+        if parent:
+            parentHash = self._hash(parent)
         if not vertex:
             vertex = {}
         if not 'type' in vertex:
             vertex['type'] = obj.__class__.__name__
-        vertexJSON = json.dumps(vertex)
-        objHash = hash(obj)
-        values = { 'hash': objHash,
-                   'parentHash': parentHash,
-                   'vertex': vertexJSON }
-        sql = 'INSERT INTO nodeLookup (hash, parentHash, vertex) VALUES (:hash, :parentHash, :vertex); '
-        self.writeBuffer.append((sql, values))
-        # return a copy of the node data with a real vertex
-        valuesCopy = values.copy()
-        valuesCopy['vertex'] = vertex
-        return valuesCopy
+        objHash = self._hash(obj)
+        self.hashRows.setdefault(objHash, []).append(len(self.nodeHashes))
+        self.nodeHashes.append(objHash)
+        self.parentHashes.append(parentHash)
+        self.vertices.append(dict(vertex))
+        # return the node data with the caller's own vertex
+        return { 'hash': objHash,
+                 'parentHash': parentHash,
+                 'vertex': vertex }
     
     def updateNode(self, node, column, value):
-        if len(self.writeBuffer) > 1000:
-            self.flushBuffer()
         if column == 'vertex':
-            value = json.dumps(value)
-        values = { 'hashValue': node['hash'],
-                   'value': value }
-        sql = 'UPDATE nodeLookup SET %s = :value WHERE hash = :hashValue; ' % column
-        self.writeBuffer.append((sql, values))
+            table = self.vertices
+            value = dict(value)
+        elif column == 'parentHash':
+            table = self.parentHashes
+        else:
+            raise ValueError('Unknown node column "%s".' % column)
+        for idx in self.hashRows.get(node['hash'], ()):
+            table[idx] = value
     
     def addEdge(self, start, relation, end, properties=None):
-        if len(self.writeBuffer) > 1000:
-            self.flushBuffer()
-        startHash = start
-        if not isinstance(start, int):
-            startHash = hash(start)
-        endHash = end
-        if not isinstance(end, int):
-            endHash = hash(end)
+        startHash = self._hash(start)
+        endHash = self._hash(end)
         if not isinstance(startHash, int) or not isinstance(endHash, int):
             raise Exception('bad hash!')
-        values = { 'start': startHash,
-                   'relation': relation,
-                   'end': endHash }
+        self.edgeStarts.append(startHash)
+        self.edgeRelationships.append(relation)
+        self.edgeEnds.append(endHash)
         if properties:
-            sql = 'INSERT INTO edges (startNodeHash, relationship, endNodeHash, properties) VALUES (:start, :relation, :end, :props); '
-            values['props'] = json.dumps(properties)
+            properties = dict(properties)
         else:
-            sql = 'INSERT INTO edges (startNodeHash, relationship, endNodeHash) VALUES (:start, :relation, :end); '
-        self.writeBuffer.append((sql, values))
-        return values
+            properties = None
+        self.edgeProperties.append(properties)
+        return { 'start': startHash,
+                 'relation': relation,
+                 'end': endHash }
 
     def getNodeFromHash(self, hashVal):
-        self.flushBuffer()
-        c = self.sqldb.cursor()
-        c.execute('SELECT * FROM nodeLookup WHERE hash = ?;', (hashVal,))
-        return c.fetchone()
+        rows = self.hashRows.get(hashVal)
+        if not rows:
+            return None
+        node = self._nodeRow(rows[0])
+        node['vertex'] = dict(node['vertex'])
+        return node
     
     def getNodeFromObject(self, obj):
-        return self.getNodeFromHash(hash(obj))
+        return self.getNodeFromHash(self._hash(obj))
     
     def getNodeBatch(self, startIdx, limit=100):
-        self.flushBuffer()
-        c = self.sqldb.cursor()
-        c.execute('SELECT * FROM nodeLookup WHERE ROWID >= :startIdx LIMIT :limit;', locals())
-        results = []
-        while True:
-            result = c.fetchone()
-            if not result:
-                break
-            results.append(result)
-        return results
+        ''' Returns up to `limit` node rows, starting with row number `startIdx`.
+        The vertices in the rows are the stored snapshots and shouldn't be modified.
+        '''
+        stopIdx = min(startIdx - 1 + limit, len(self.nodeHashes))
+        return [self._nodeRow(i) for i in xrange(startIdx - 1, stopIdx)]
     
     def getEdgeBatch(self, startIdx, limit=100):
-        self.flushBuffer()
-        c = self.sqldb.cursor()
-        c.execute('SELECT * FROM edges WHERE ROWID >= :startIdx LIMIT :limit;', locals())
-        return c.fetchall()    
+        ''' Returns up to `limit` relationship rows, starting with row number `startIdx`.
+        The start and end nodes are also given as node row numbers, using the last
+        node row added for each hash.
+        '''
+        stopIdx = min(startIdx - 1 + limit, len(self.edgeStarts))
+        hashRows = self.hashRows
+        return [{ 'startNodeHash': self.edgeStarts[i],
+                  'startNodeRow': hashRows[self.edgeStarts[i]][-1] + 1,
+                  'relationship': self.edgeRelationships[i],
+                  'endNodeHash': self.edgeEnds[i],
+                  'endNodeRow': hashRows[self.edgeEnds[i]][-1] + 1,
+                  'properties': self.edgeProperties[i] }
+                for i in xrange(startIdx - 1, stopIdx)]
+    
+    def countNodes(self):
+        return len(self.nodeHashes)
 
 #-------------------------------------------------------------------------------
 class Database(object):
@@ -410,29 +584,34 @@ class Database(object):
     '''
     
     _DOC_ORDER = [ 'wipeDatabase', 'addScore', 'listScores', 'listNodeTypes', 'listNodeProperties',
-                   'listRelationshipTypes', 'listRelationshipProperties', 'addPropertyCallback' ]
+                   'listRelationshipTypes', 'listRelationshipProperties', 'refreshSchema',
+                   'addPropertyCallback' ]
     _DOC_ATTR = {
     'graph_db': 'The instance of a :class:`py2neo.neo4j.GraphDatabaseService` object connected to this object, which is in turn connected to a Neo4j server either at the default location on the present computer, or the one specified by the Database `uri` argument.',
     }
-    HIDEFROMDATABASE = 1
+    HIDEFROMDATABASE = _HideFromDatabase()
+    WRITE_THREADS = 4  # concurrent requests used by addScore to write to the database
+    WRITE_BATCH_SIZE = 1000  # nodes or relationships sent in each of those requests
 
-    def __init__(self, uri='http://localhost:7474/db/data/', **kwargs):
+    def __init__(self, uri=_DEFAULT_URI, **kwargs):
         self.uri = uri
         self.dbargs = kwargs
         self._refreshGraphDB()
         self._db_kwargs = kwargs
         self._db_uri = uri
         self._callbacks = {}
+        self._callbackCache = {}  # class -> the callbacks that apply to it, in order
+        self._leafCache = {}  # class -> True if its contents aren't extracted
         self._extractState = {}
-        self._defaultCallbacks()
-        self._m21SuperclassLookup = self._inspectMusic21ExpressionsArticulations()
-        self._skipProperties = ('_activeSite', 'id', '_classes', 'groups', 'sites',
+        self._skipProperties = frozenset(('_activeSite', 'id', '_classes', 'groups', 'sites',
                                '_derivation', '_overriddenLily', '_definedContexts', '_activeSiteId',
                                '_idLastDeepCopyOf', '_mutable', '_elements', '_cache', 'isFlat',
                                'autosort', '_components', '_unlinkedDuration', 'isSorted',
                                'flattenedRepresentationOf', '_reprHead', 'idLocal', 'autoSort',
                                'inherited', '_fullyQualifiedClasses', 'filePath', 'fileFormat',
-                               'fileNumber', 'spannedElements') 
+                               'fileNumber', 'spannedElements'))
+        self._defaultCallbacks()
+        self._m21SuperclassLookup = self._inspectMusic21ExpressionsArticulations()
 
     def _refreshGraphDB(self):
         try:
@@ -457,24 +636,28 @@ class Database(object):
         The node count can never go below 1 because Neo4j always keeps a reference node 
         in its network graph.
         '''
-        q = Query(self)
-        q.setStartRelationship()
-        rGen = q.results()
-        while True:
-            results = rGen.next(limit=100)
-            if not results:
-                break
-            results = [x[0] for x in results]
-            _serverCall(self.graph_db.delete, *results)
-        q = Query(self)
-        q.setStartNode()
-        rGen = q.results()
-        while True:
-            results = rGen.next(limit=100)
-            if not results:
-                break
-            results = [x[0] for x in results]
-            _serverCall(self.graph_db.delete, *results)
+        try:
+            for queryText in ('START r=relationship:relationship_auto_index("type:*") DELETE r;',
+                              'START n=node:node_auto_index("type:*") DELETE n;'):
+                _serverCall(py2neo.neo4j.CypherQuery(self.graph_db, queryText).run)
+        except py2neo.neo4j.CypherError:
+            self._wipeDatabaseInBatches()
+        self.refreshSchema()
+
+    def _wipeDatabaseInBatches(self, batchSize=10000):
+        '''Deletes relationships and then nodes `batchSize` at a time on the server,
+        for servers that can't handle the Cypher statements in :meth:`wipeDatabase`
+        in a single transaction.
+        '''
+        for queryText in ('START r=relationship:relationship_auto_index("type:*") '
+                          'WITH r LIMIT {batchSize} DELETE r RETURN count(*);',
+                          'START n=node:node_auto_index("type:*") '
+                          'WITH n LIMIT {batchSize} DELETE n RETURN count(*);'):
+            query = py2neo.neo4j.CypherQuery(self.graph_db, queryText)
+            while True:
+                results = _serverCall(lambda: query.execute(batchSize=batchSize))
+                if not results.data or not results.data[0].values[0]:
+                    break
 
     def addScore(self, score, verbose=False):
         '''Adds a music21 :class:`~music21.stream.Score` to the database.
@@ -495,15 +678,13 @@ class Database(object):
         >>> print db.graph_db.get_relationship_count()
         1517
         '''
-        self.nodeRefs = {}
+        self.nodeRefs = []
         self.maxNodes = 0
         self.maxEdges = 0
         self.nodeFarm = NodeFarm()
         self._extractState = { 'verbose': verbose,
                               'nodeCnt': 0,
-                              'relationCnt': 0,
-                              'nodeLookup': {} }  # vertex, parent, voice
-        import copy
+                              'relationCnt': 0 }
         if verbose:
             self.lastProgress = 0
             self._timeUpdate(report=False)
@@ -512,6 +693,7 @@ class Database(object):
         self._extractNodes(score)        
         self._writeNodesToDatabase()        
         self._writeEdgesToDatabase(score)
+        self.refreshSchema()
 
     def listScores(self): # start=0, limit=100):
         '''Returns a list of dict objects with information about the scores that have been added 
@@ -580,35 +762,43 @@ class Database(object):
         '''
         if hasattr(self, 'nodeProperties'):
             return self.nodeProperties
-        if not hasattr(self, 'nTypes'):
-            self.listNodeTypes()
-        self.nodeProperties = []
-        self.nodePropertyValues = []
-        q = Query(self)
-        q.limitReturnToWhere = False
-        for nodeType in self.nTypes:
-            q.setStartNode(nodeType=nodeType) #, noIndex=True)
-            rGen = q.results(limit=1000, omitStart=True)
-            results = rGen.fetch_all()
-            results = [x[0] for x in results]
-            nodes = _serverCall(self.graph_db.get_properties, *results)
-            properties = {}
-            for node in nodes:
-                for prop in node:
-                    if prop == 'type':
-                        continue
-                    try:
-                        propSet = properties[prop]
-                    except:
-                        propSet = properties[prop] = set()
-                    propSet.add(node[prop])
+        if self._restoreSchema('nodeProperties', 'nodePropertyValues'):
+            return self.nodeProperties
+        nodeProperties = []
+        nodePropertyValues = []
+        # Sample up to 1000 nodes of each type, streaming them as they arrive.
+        queryText = 'START n=node:node_auto_index({query}) RETURN n LIMIT 1000;'
+        for nodeType in self.listNodeTypes():
+            properties = self._sampleProperties(queryText, nodeType)
             for p in properties:
-                self.nodeProperties.append((nodeType, p))
+                nodeProperties.append((nodeType, p))
                 values = list(properties[p])
                 values.sort()
-                self.nodePropertyValues.append((nodeType, p, tuple(values)))
+                nodePropertyValues.append((nodeType, p, tuple(values)))
+        self.nodeProperties = nodeProperties
+        self.nodePropertyValues = nodePropertyValues
+        self._saveSchema('nodeProperties', 'nodePropertyValues')
         return self.nodeProperties
     
+    def _sampleProperties(self, queryText, entityType):
+        ''' Runs `queryText`, a query for a sample of the nodes or relationships 
+        of type `entityType`, and returns a dict of the values of each property.
+        '''
+        properties = {}
+        rGen = Results(queryText, {'query': 'type:%s' % entityType}, db=self)
+        rGen.start()
+        for row in rGen:
+            metadata = _getPy2neoMetadata(row[0])
+            for prop in metadata:
+                if prop == 'type':
+                    continue
+                try:
+                    propSet = properties[prop]
+                except:
+                    propSet = properties[prop] = set()
+                propSet.add(metadata[prop])
+        return properties
+
     def listNodePropertyValues(self):
         '''Returns a list of lists of values used by node properties in the database
         (node type, property name, (value1, value2, ...)).
@@ -642,13 +832,15 @@ class Database(object):
         '''
         if hasattr(self, 'rTypes'):
             return self.rTypes
-        self.rTypes = []
-        self.nTypes = set()
+        if self._restoreSchema('rTypes', 'nTypes'):
+            return self.rTypes
+        # The attributes are only set once every query has succeeded.
+        nTypes = set()
         rTypes = set()
         relateTypes = []
         while not relateTypes:
             queryText = 'START r=relationship(*) RETURN DISTINCT TYPE(r);'
-            rGen = Results(queryText)
+            rGen = Results(queryText, db=self)
             rGen.start()
             relateTypes = rGen.fetch_all()
             #relateTypes, metadata = _cypherQuery(self.graph_db, queryText)
@@ -661,10 +853,11 @@ class Database(object):
             results = rGen.fetch_all()
             for n1, n2 in results:
                 rTypes.add((n1, relateType[0], n2))
-                self.nTypes.add(n1)
-                self.nTypes.add(n2)
-        for start, r, end in rTypes:
-            self.rTypes.append({ 'start': start, 'type': r, 'end': end })
+                nTypes.add(n1)
+                nTypes.add(n2)
+        self.rTypes = [{ 'start': start, 'type': r, 'end': end } for start, r, end in rTypes]
+        self.nTypes = nTypes
+        self._saveSchema('rTypes', 'nTypes')
         return self.rTypes
     
     def listRelationshipProperties(self):
@@ -681,34 +874,22 @@ class Database(object):
         '''
         if hasattr(self, 'relateProperties'):
             return self.relateProperties
-        rTypes = set()
-        for x in self.listRelationshipTypes():
-            rTypes.add(x['type']) 
-        self.relateProperties = []
-        self.relatePropertyValues = []
-        for rType in rTypes:
-            q = Query(self)
-            r = q.setStartRelationship(relationType=rType)
-            q.addReturns(r.name)
-            rGen = q.results(limit=1000, omitStart=True)
-            results = rGen.fetch_all()
-            results = [x[0] for x in results]
-            nodes = _serverCall(self.graph_db.get_properties, *results)
-            properties = {}
-            for relate in nodes:
-                for prop in relate:
-                    if prop == 'type':
-                        continue
-                    try:
-                        propSet = properties[prop]
-                    except:
-                        propSet = properties[prop] = set()
-                    propSet.add(relate[prop])
+        if self._restoreSchema('relateProperties', 'relatePropertyValues'):
+            return self.relateProperties
+        relateProperties = []
+        relatePropertyValues = []
+        # Sample up to 1000 relationships of each type, streaming them as they arrive.
+        queryText = 'START r=relationship:relationship_auto_index({query}) RETURN r LIMIT 1000;'
+        for rType in set(x['type'] for x in self.listRelationshipTypes()):
+            properties = self._sampleProperties(queryText, rType)
             for p in properties:
-                self.relateProperties.append((rType, p))
+                relateProperties.append((rType, p))
                 values = list(properties[p])
                 values.sort()
-                self.relatePropertyValues.append((rType, p, tuple(values)))
+                relatePropertyValues.append((rType, p, tuple(values)))
+        self.relateProperties = relateProperties
+        self.relatePropertyValues = relatePropertyValues
+        self._saveSchema('relateProperties', 'relatePropertyValues')
         return self.relateProperties
 
     def listRelationshipPropertyValues(self):
@@ -727,6 +908,85 @@ class Database(object):
         self.listRelationshipProperties()
         return self.relatePropertyValues                
     
+    def refreshSchema(self):
+        '''Discards the cached results of the `list*` methods, both in memory and on disk,
+        so that they will be read from the database again.
+        
+        The results are cached on disk (in the user's home folder) so that they can
+        be reused by later Database objects, and the cache is
+        keyed on the number of nodes and relationships in the database. This method
+        only needs to be called when the database has been changed without changing
+        those counts, or by a method other than :meth:`addScore` or :meth:`wipeDatabase`.
+        '''
+        for name in _SCHEMA_DECODERS:
+            if name in self.__dict__:
+                delattr(self, name)
+        path = self.__dict__.pop('_schemaCachePath', None)
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def _getSchemaCachePath(self):
+        if not hasattr(self, '_schemaCachePath'):
+            # The counts can repeat after a wipe, so the relationship types are hashed too.
+            counts = (_serverCall(self.graph_db.get_node_count),
+                      _serverCall(self.graph_db.get_relationship_count))
+            query = py2neo.neo4j.CypherQuery(self.graph_db, 
+                'START r=relationship:relationship_auto_index("type:*") RETURN DISTINCT r.type;')
+            types = sorted(row.values[0] for row in _serverCall(query.execute).data)
+            key = hashlib.md5(repr(counts + tuple(types))).hexdigest()
+            self._schemaCachePath = os.path.join(os.path.expanduser('~'), 
+                                                 '%s%s.json' % (self._schemaCachePrefix(), key))
+        return self._schemaCachePath
+
+    def _schemaCachePrefix(self):
+        # All the cache files for one database share this prefix.
+        return '.musicnet_schema_%s_' % hashlib.md5(self.uri).hexdigest()
+
+    def _loadSchemaCache(self):
+        try:
+            with open(self._getSchemaCachePath()) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _restoreSchema(self, *names):
+        '''Sets the named schema attributes from the disk cache.
+        Returns True if all of them were found.
+        '''
+        cache = self._loadSchemaCache()
+        if not all(name in cache for name in names):
+            return False
+        for name in names:
+            setattr(self, name, _SCHEMA_DECODERS[name](cache[name]))
+        return True
+
+    def _saveSchema(self, *names):
+        # An empty sample means the database is empty or the query failed,
+        # and either way it shouldn't be reused.
+        if not all(getattr(self, name) for name in names):
+            return
+        cache = self._loadSchemaCache()
+        for name in names:
+            value = getattr(self, name)
+            if isinstance(value, set):
+                value = list(value)
+            cache[name] = value
+        path = self._getSchemaCachePath()
+        try:
+            with open(path, 'w') as f:
+                json.dump(cache, f)
+        except IOError:
+            return
+        # Remove the files left from earlier states of the same database.
+        directory, filename = os.path.split(path)
+        prefix = self._schemaCachePrefix()
+        for other in os.listdir(directory):
+            if other.startswith(prefix) and other != filename:
+                try:
+                    os.remove(os.path.join(directory, other))
+                except OSError:
+                    pass
+
     def addPropertyCallback(self, entity, callback):
         '''**For advanced use only.**
         
@@ -743,6 +1003,7 @@ class Database(object):
         if entity not in self._callbacks:
             self._callbacks[entity] = []
         self._callbacks[entity].append(callback)
+        self._callbackCache.clear()
 
     def _defaultCallbacks(self):
         HIDEFROMDATABASE = self.HIDEFROMDATABASE
@@ -767,7 +1028,7 @@ class Database(object):
         
         # Part
         def resetExtractState(db, part, partVertex, scoreNode):
-            db._extractState['history'] = { 'NoteToNote': {} }
+            db._extractState['history'] = { 'NoteToNote': {} }  # (voice, byBeat) -> (note, offset)
             for key in ('clef', 'timeSignature', 'keySignatureSharps', 'keySignatureMode'):
                 db._extractState[key] = None
         self.addPropertyCallback('Part', resetExtractState)
@@ -776,7 +1037,7 @@ class Database(object):
         # Measure
         def addSignaturesAndClefs(db, measure, vertex, partNode):
             if measure.clef:
-                self._extractState['clef'] = measure.clef.classes[0]
+                self._extractState['clef'] = measure.clef.__class__.__name__
             # vertex['barDuration'] = self._extractState['barDuration']
             vertex['clef'] = self._extractState['clef']
             if measure.timeSignature:
@@ -807,73 +1068,10 @@ class Database(object):
             return HIDEFROMDATABASE
         self.addPropertyCallback('Voice', labelVoiceNotes)
 
-        # Note
-        def addNoteVoiceleading(db, noteObj, vertex, measureNode):
-            def addVoiceleading(db, byBeat, noteVertex, measureNode):
-                if noteObj.isRest:
-                    return
-                history = db._extractState['history']
-                voice = noteVertex['voice']
-                try:
-                    prevNote, prevOffset = history['NoteToNote'][voice][byBeat]
-                    voiceleadingHistory = True
-                except KeyError:
-                    voiceleadingHistory = False
-                # Only calculate voiceleading for notes within the span of a measure.
-                if (voiceleadingHistory and 
-                        offset - prevOffset <= self._extractState['barDuration']):
-                    mint = noteObj.midi - prevNote.midi
-                    db._addEdge(prevNote, 'NoteToNote', noteObj, { 'interval': mint, 'byBeat': byBeat })
-                try:
-                    saveLoc = history['NoteToNote'][voice]
-                except KeyError:
-                    saveLoc = history['NoteToNote'][voice] = {}
-                saveLoc[byBeat] = [noteObj, offset]
-            
-            offset = measureNode['vertex']['offset'] + noteObj.offset
-            if 'voice' not in vertex:
-                vertex['voice'] = 1
-            addVoiceleading(db, 'False', vertex, measureNode)
-            if noteObj.offset % 1 == 0:
-                addVoiceleading(db, 'True', vertex, measureNode)
-            # del vertex['voice']
-        self.addPropertyCallback('Note', addNoteVoiceleading)
-
-        # Pitch
-        def addPitchToNote(db, pitchObj, pitchVertex, noteNode):
-            noteVertex = noteNode['vertex']
-            noteVertex['pitch'] = pitchObj.nameWithOctave
-            noteVertex['midi'] = pitchObj.midi
-            noteVertex['microtone'] = pitchObj.microtone.cents
-            self.nodeFarm.updateNode(noteNode, 'vertex', noteVertex)
-            return HIDEFROMDATABASE
-        self.addPropertyCallback('Pitch', addPitchToNote)
-
-        # Duration
-        def addDurationToParent(db, durationObj, vertex, parentNode):
-            if (durationObj.quarterLength == 0):
-                return HIDEFROMDATABASE
-            parentVertex = parentNode['vertex']
-            parentType = parentVertex['type']
-            needsUpdate = False
-            if parentType not in ('StaffGroup', 'Instrument', 'Metadata'):
-                parentVertex['quarterLength'] = durationObj.quarterLength
-                if (durationObj.tuplets):
-                    tuplets = []
-                    for tuplet in durationObj.tuplets:
-                        tuplets.append('%d:%d' % (tuplet.tupletActual[0], tuplet.tupletNormal[0]))
-                    parentVertex['tuplet'] = '*'.join(tuplets)
-                needsUpdate = True
-            if parentType == 'Note':
-                parentVertex['isGrace'] = durationObj.isGrace
-                if hasattr(durationObj, 'stealTimePrevious'):
-                    for attr in ('stealTimePrevious', 'stealTimeFollowing', 'slash'):
-                        parentVertex[attr] = getattr(durationObj, attr)
-                needsUpdate = True
-            if needsUpdate:
-                self.nodeFarm.updateNode(parentNode, 'vertex', parentVertex)
-            return HIDEFROMDATABASE
-        self.addPropertyCallback('Duration', addDurationToParent)
+        # Note, Pitch, Duration: these run for every note, so they are methods.
+        self.addPropertyCallback('Note', self._addNoteVoiceleading)
+        self.addPropertyCallback('Pitch', self._addPitchToNote)
+        self.addPropertyCallback('Duration', self._addDurationToParent)
         
         # MetronomeMark
         def simplifyText(db, mm, vertex, partNode):
@@ -883,11 +1081,18 @@ class Database(object):
         self.addPropertyCallback('MetronomeMark', simplifyText)
         
         # Expression, Articulation
+        abstractTypes = {}  # class -> 'Expression' or 'Articulation'
         def useAbstractType(db, obj, vertex, noteNode):
-            abstractions = ('Expression', 'Articulation')
-            superclass = [x for x in obj.classes if x in abstractions][0]
-            vertex['type'] = superclass
-            vertex['name'] = obj.__class__.__name__
+            cls = obj.__class__
+            abstractType = abstractTypes.get(cls)
+            if abstractType is None:
+                if 'Expression' in obj.classes:
+                    abstractType = 'Expression'
+                else:
+                    abstractType = 'Articulation'
+                abstractTypes[cls] = abstractType
+            vertex['type'] = abstractType
+            vertex['name'] = cls.__name__
         self.addPropertyCallback('Expression', useAbstractType)
         self.addPropertyCallback('Articulation', useAbstractType)
 
@@ -919,31 +1124,28 @@ class Database(object):
         
         # Moment
         def addCrossPartRelationships(db, moment, vertex, scoreNode):
-            simultaneous = list(moment.simultaneous)
-            for noteObj in simultaneous:
-                db._addEdge(noteObj, 'MomentInNote', moment, { 'startMoment': False })
-            sameOffset = list(moment.sameOffset)
-            for noteObj in sameOffset:
-                db._addEdge(noteObj, 'MomentInNote', moment, { 'startMoment': True })
-            notes = sameOffset + simultaneous
-            simuls = {}
+            # The notes starting at the moment come first, then the held-over ones.
+            notes = list(moment.sameOffset)
+            startCount = len(notes)
+            notes.extend(moment.simultaneous)
+            for i, noteObj in enumerate(notes):
+                db._addEdge(noteObj, 'MomentInNote', moment, { 'startMoment': i < startCount })
+            # Read each note's pitch and offset once, not once per pair.
+            midis = [n.midi for n in notes]
+            offsets = [n.offset for n in notes]
             for i in range(len(notes) - 1):
                 note1 = notes[i]
+                midi1 = midis[i]
+                offset1 = offsets[i]
                 for j in range(i + 1, len(notes)):
                     note2 = notes[j]
-                    if note1 in simuls:
-                        if note2 in simuls[note1]: continue
-                    else:
-                        simuls[note1] = {}
-                    if note2 in simuls and note1 in simuls[note2]:
-                        continue
-                    simuls[note1][note2] = True
-                    cInt = note1.midi - note2.midi
-                    sInt = _signedModulo(note1.midi - note2.midi, 12)
+                    cInt = midi1 - midis[j]
+                    # inlined _signedModulo(cInt, 12)
+                    sInt = cInt % 12 if cInt >= 0 else -(-cInt % 12)
                     properties = { 'harmonicInterval': cInt,
                                    'simpleHarmonicInterval': sInt,
                                    'sameOffset': 'False' }
-                    if note1.offset == note2.offset:
+                    if offset1 == offsets[j]:
                         properties['sameOffset'] = 'True'
                     db._addEdge(note1, 'NoteSimultaneousWithNote', note2, properties)
         self.addPropertyCallback('Moment', addCrossPartRelationships)
@@ -974,15 +1176,17 @@ class Database(object):
 
         # Optional objects
         # NoteEditorial
+        skipProperties = self._skipProperties
         def skipIfEmpty(db, obj, vertex=None, parentNode=None):
             objDict = obj.__dict__
             for key, val in objDict.iteritems():
-                if key in self._skipProperties:
+                # Most attributes are empty, so check that first.
+                if not val:
+                    continue
+                if key in skipProperties:
                     continue
                 if key == 'position':
                     continue  # There are empty objects with non-empty positions.
-                if not val:
-                    continue
                 if hasattr(val, '__dict__'):
                     if skipIfEmpty(db, val):
                         continue
@@ -1007,8 +1211,61 @@ class Database(object):
         self.addPropertyCallback('RTPhraseBoundary', skipThisObject)
         self.addPropertyCallback('StreamStatus', skipThisObject)
 
+    def _addNoteVoiceleading(self, db, noteObj, vertex, measureNode):
+        offset = measureNode['vertex']['offset'] + noteObj.offset
+        if 'voice' not in vertex:
+            vertex['voice'] = 1
+        self._addVoiceleading(noteObj, offset, 'False', vertex)
+        if noteObj.offset % 1 == 0:
+            self._addVoiceleading(noteObj, offset, 'True', vertex)
+
+    def _addVoiceleading(self, noteObj, offset, byBeat, noteVertex):
+        if noteObj.isRest:
+            return
+        history = self._extractState['history']['NoteToNote']
+        key = (noteVertex['voice'], byBeat)
+        previous = history.get(key)
+        # Only calculate voiceleading for notes within the span of a measure.
+        if previous is not None:
+            prevNote, prevOffset = previous
+            if offset - prevOffset <= self._extractState['barDuration']:
+                mint = noteObj.midi - prevNote.midi
+                self._addEdge(prevNote, 'NoteToNote', noteObj, { 'interval': mint, 'byBeat': byBeat })
+        history[key] = (noteObj, offset)
+
+    def _addPitchToNote(self, db, pitchObj, pitchVertex, noteNode):
+        noteVertex = noteNode['vertex']
+        noteVertex['pitch'] = pitchObj.nameWithOctave
+        noteVertex['midi'] = pitchObj.midi
+        noteVertex['microtone'] = pitchObj.microtone.cents
+        return self.HIDEFROMDATABASE
+
+    def _addDurationToParent(self, db, durationObj, vertex, parentNode):
+        if (durationObj.quarterLength == 0):
+            return self.HIDEFROMDATABASE
+        parentVertex = parentNode['vertex']
+        parentType = parentVertex['type']
+        if parentType not in _UNTIMED_TYPES:
+            parentVertex['quarterLength'] = durationObj.quarterLength
+            if (durationObj.tuplets):
+                tuplets = []
+                for tuplet in durationObj.tuplets:
+                    tuplets.append('%d:%d' % (tuplet.tupletActual[0], tuplet.tupletNormal[0]))
+                parentVertex['tuplet'] = '*'.join(tuplets)
+        if parentType == 'Note':
+            parentVertex['isGrace'] = durationObj.isGrace
+            try:
+                stealTimePrevious = durationObj.stealTimePrevious
+            except AttributeError:
+                pass
+            else:
+                # grace note durations
+                parentVertex['stealTimePrevious'] = stealTimePrevious
+                parentVertex['stealTimeFollowing'] = durationObj.stealTimeFollowing
+                parentVertex['slash'] = durationObj.slash
+        return self.HIDEFROMDATABASE
+
     def _inspectMusic21ExpressionsArticulations(self):
-        import inspect
         lookup = {}
         # search music21 modules:
         for module in (music21.expressions, music21.articulations):
@@ -1033,9 +1290,11 @@ class Database(object):
         progress = rangeOut * (state - minIn) / rangeIn + minOut
         progress = 5 * round(progress / 5)
         if progress >= lastOut + 5:
+            # Draw every step passed since the last call, not just one.
+            steps = int((progress - lastOut) / 5)
             increment = int(60.0 * (5.0 / rangeOut))
-            sys.stderr.write('=' * increment)
-            self.lastProgress = progress
+            sys.stderr.write('=' * increment * steps)
+            self.lastProgress = lastOut + 5 * steps
     
     def _extractNodes(self, obj, parentNode=None):
         '''
@@ -1043,30 +1302,32 @@ class Database(object):
         At this point relationships store references to the original music21 objects.
         '''
         state = self._extractState
-        if state['verbose'] and parentNode and parentNode['vertex']['type'] in ('Part', 'PartStaff'):
-            state['partItemCnt'] = state.get('partItemCnt', 0) + 1
-            self._progressReport(state['partItemCnt'], 0, state['partItemMax'], 0, 5)
-        objNode = self._addNode(obj, parentNode)
-        if objNode == self.HIDEFROMDATABASE:
-            return
-        if hasattr(obj, 'classes') and 'Spanner' in obj.classes:
-            return
-        if obj.__class__.__name__ == 'Moment':
-            return
-        try:
-            itemList = list(obj)
-        except TypeError:
-            return
-        for item in itemList:
-            if item == obj:
+        # Depth-first, in the same order as a recursive walk.
+        stack = [(obj, parentNode)]
+        while stack:
+            obj, parentNode = stack.pop()
+            if state['verbose'] and parentNode and parentNode['vertex']['type'] in ('Part', 'PartStaff'):
+                state['partItemCnt'] = state.get('partItemCnt', 0) + 1
+                self._progressReport(state['partItemCnt'], 0, state['partItemMax'], 0, 5)
+            objNode = self._addNode(obj, parentNode)
+            # _addNode returns None for Spanners and Moments, whose contents aren't extracted.
+            if objNode is None or objNode is self.HIDEFROMDATABASE:
+                continue
+            try:
+                itemList = list(obj)
+            except TypeError:
                 continue
-            self._extractNodes(item, objNode)
+            for item in reversed(itemList):
+                if item == obj:
+                    continue
+                stack.append((item, objNode))
 
     def _addNode(self, node, parentData=None, vertex=None):
         #if getattr(node, 'addedToDB', False):
         #    return self.HIDEFROMDATABASE
 #        print node ###
-        kind = node.__class__.__name__
+        cls = node.__class__
+        kind = cls.__name__
         if not vertex:
             ref = self.nodeFarm.getNodeFromObject(node)
             if ref:
@@ -1077,7 +1338,7 @@ class Database(object):
             vertex['type'] = kind
         if hasattr(node, 'offset'):
             vertex['offset'] = node.offset
-        if self._runCallbacks(node, vertex, parentData) == self.HIDEFROMDATABASE:
+        if self._runCallbacks(node, vertex, parentData) is self.HIDEFROMDATABASE:
             return self.HIDEFROMDATABASE
         parentHash = None
         if parentData:
@@ -1087,7 +1348,11 @@ class Database(object):
         if parentData:
             relation = nodeData['vertex']['type'] + 'In' + parentData['vertex']['type']
             self._addEdge(node, relation, parentData['hash'], { 'structural': True })
-        if 'Spanner' in getattr(node, '_classes', []) or kind == 'Moment':
+        isLeaf = self._leafCache.get(cls)
+        if isLeaf is None:
+            isLeaf = self._leafCache[cls] = (kind == 'Moment' or 
+                                             'Spanner' in getattr(node, 'classes', ()))
+        if isLeaf:
             return
         self._extractObject(node, nodeData)
         return nodeData
@@ -1105,22 +1370,24 @@ class Database(object):
         self.maxEdges = self.maxEdges + 1
            
     def _runCallbacks(self, node, nodeData, parentData):
-        keys = self._callbacks.keys()
-        if hasattr(node, 'classes'):
-            kinds = [x for x in node.classes if x in keys]
-        else:
-            name = node.__class__.__name__
-            try: 
-                kinds = [name, self._m21SuperclassLookup[name]]
-            except KeyError:
-                kinds = [name]
-        for kind in kinds:
-            if kind not in self._callbacks:
-                continue
-            for callback in self._callbacks[kind]:
-                rc = callback(self, node, nodeData, parentData)
-                if rc != None:
-                    return rc
+        # The callbacks only depend on the class, so look them up once per class.
+        cls = node.__class__
+        callbacks = self._callbackCache.get(cls)
+        if callbacks is None:
+            if hasattr(node, 'classes'):
+                kinds = node.classes
+            else:
+                name = cls.__name__
+                try: 
+                    kinds = (name, self._m21SuperclassLookup[name])
+                except KeyError:
+                    kinds = (name,)
+            callbacks = self._callbackCache[cls] = tuple(callback for x in kinds 
+                                                         for callback in self._callbacks.get(x, ()))
+        for callback in callbacks:
+            rc = callback(self, node, nodeData, parentData)
+            if rc is not None:
+                return rc
 
     # get data from object; extract subnodes if necessary
     def _extractObject(self, obj, objData=None, parentNode=None):
@@ -1134,8 +1401,9 @@ class Database(object):
             self.maxNodes = self.maxNodes + 1
         objectDict = obj.__dict__
         vertex = objData['vertex']
+        skipProperties = self._skipProperties
         for key, val in objectDict.iteritems():
-            if key in self._skipProperties:
+            if key in skipProperties:
                 continue
             if val == None and key in ('_duration'):
                 continue
@@ -1158,76 +1426,141 @@ class Database(object):
                 key = 'm21_' + key
             if key not in vertex:
                 vertex[key] = val
-        for key, val in vertex.items():
-            if not isinstance(val, (int, float, long)):
-                val = unicode(val)
-            if key not in vertex:
-                vertex[key] = val
         self.nodeFarm.updateNode(objData, 'vertex', vertex)
         return objData
     
+    def _createInParallel(self, batches, handleResults=None, create=_createEntities):
+        '''
+        Sends each batch of nodes or relationships in `batches` to the database
+        with `create(graph_db, items)`, using a pool of WRITE_THREADS writer threads so that
+        several HTTP requests are in flight at once. Each item in `batches` is a tuple
+        (batch, items), and `handleResults(batch, results)` is called in this thread
+        as each batch is created. Batches can finish in any order.
+        '''
+        tasks = Queue.Queue(maxsize=2 * self.WRITE_THREADS)
+        done = Queue.Queue()
+        
+        def write():
+            # Each thread gets its own connection to the database.
+            graph_db = py2neo.neo4j.GraphDatabaseService(self.uri, **self.dbargs)
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                batch, items = task
+                try:
+                    done.put((batch, _createSplitting(graph_db, items, create), None))
+                except Exception:
+                    done.put((batch, None, sys.exc_info()))
+        
+        def finish(batch, results, error):
+            if error:
+                raise error[0], error[1], error[2]
+            if handleResults:
+                handleResults(batch, results)
+        
+        threads = [threading.Thread(target=write) for _ in range(self.WRITE_THREADS)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        pending = 0
+        try:
+            for task in batches:
+                tasks.put(task)
+                pending += 1
+                while not done.empty():
+                    finish(*done.get())
+                    pending -= 1
+            while pending:
+                finish(*done.get())
+                pending -= 1
+        except:
+            error = sys.exc_info()
+            # Drop the batches that haven't been sent yet.
+            try:
+                while True:
+                    tasks.get_nowait()
+            except Queue.Empty:
+                pass
+            raise error[0], error[1], error[2]
+        finally:
+            for t in threads:
+                tasks.put(None)
+            for t in threads:
+                t.join()
+    
     def _writeNodesToDatabase(self):
         '''
         When nodes are written to the database in order, 
         references to their database entries will be returned in the same order.
-        Those references are saved as attributes in the original nodes.
+        Those references are saved in `nodeRefs`, indexed by node row.
         '''
-        batchSize = 100
+        batchSize = self.WRITE_BATCH_SIZE
         verbose = self._extractState['verbose']
         if verbose:
             self._timeUpdate()
             sys.stderr.write('Writing nodes to database...........')
-        idx = 1
         self._refreshGraphDB()
-        while True:
-            subset = self.nodeFarm.getNodeBatch(idx, batchSize)
-            batchLen = len(subset)
-            if batchLen == 0:
-                break
-            vertices = [x['vertex'] for x in subset]
-            results = _serverCall(self.graph_db.create, *vertices)
-            # Store a nodeRef reference for each music21 object 
+        self.nodeRefs = [None] * self.nodeFarm.countNodes()
+        
+        def nodeBatches():
+            idx = 1
+            while True:
+                subset = self.nodeFarm.getNodeBatch(idx, batchSize)
+                if not subset:
+                    return
+                yield (idx, len(subset)), [x['vertex'] for x in subset]
+                idx += len(subset)
+        
+        def storeRefs(batch, results):
+            # Store a reference for each node row 
             # with the address of its corresponding Neo4j node.
-            for i in range(len(results)):
-                self.nodeRefs[subset[i]['hash']] = results[i]
+            idx, size = batch
+            if len(results) != size:
+                # Any other count would wire the edges to the wrong nodes.
+                raise ValueError('Expected %d nodes from the database starting at row %d, got %d.'
+                                 % (size, idx, len(results)))
+            self.nodeRefs[idx - 1:idx - 1 + size] = results
             self._extractState['nodeCnt'] += len(results)
-            idx += len(results)
             if verbose:
-                self._progressReport(idx, 0, self.maxNodes, 5, 25)
+                self._progressReport(self._extractState['nodeCnt'], 0, self.maxNodes, 5, 25)
+        
+        self._createInParallel(nodeBatches(), storeRefs, _createNodes)
         
     def _writeEdgesToDatabase(self, score):
         '''
         Before relationships are written to the database, music21 object references are converted 
         to their corresponding database nodes.
         '''
-        batchSize = 100
+        batchSize = self.WRITE_BATCH_SIZE
         verbose = self._extractState['verbose']
         if verbose:
             self._timeUpdate()
             sys.stderr.write('Writing relationships to database...')
-        idx = 1
-        while True:
-            subset = self.nodeFarm.getEdgeBatch(idx, batchSize)
-            batchLen = len(subset)
-            if batchLen == 0:
-                break
-            edgeRefs = []
-            for edge in subset:
-#                print edge['relationship'] ###
-#                if edge['properties']:
-#                    print '   ' + repr(edge['properties'])
-                ref1 = self.nodeRefs[edge['startNodeHash']]
-#                print '  getting endNode' ###
-                ref2 = self.nodeRefs[edge['endNodeHash']]
-                edgeRef = [ref1, edge['relationship'], ref2]
-                if edge['properties']:
-                    edgeRef.append(edge['properties'])
-                edgeRefs.append(tuple(edgeRef))
-            _serverCall(self.graph_db.create, *edgeRefs)
-            # self._extractState['relationCnt'] += batchLen
-            idx += batchSize
+        
+        def edgeBatches():
+            idx = 1
+            while True:
+                subset = self.nodeFarm.getEdgeBatch(idx, batchSize)
+                if not subset:
+                    return
+                edgeRefs = []
+                for edge in subset:
+                    ref1 = self.nodeRefs[edge['startNodeRow'] - 1]
+                    ref2 = self.nodeRefs[edge['endNodeRow'] - 1]
+                    edgeRef = [ref1, edge['relationship'], ref2]
+                    if edge['properties']:
+                        edgeRef.append(edge['properties'])
+                    edgeRefs.append(tuple(edgeRef))
+                yield subset, edgeRefs
+                idx += len(subset)
+        
+        def countEdges(subset, results):
+            self._extractState['relationCnt'] += len(subset)
             if verbose:
-                self._progressReport(idx, 0, self.maxEdges, 25, 100)
+                self._progressReport(self._extractState['relationCnt'], 0, self.maxEdges, 25, 100)
+        
+        self._createInParallel(edgeBatches(), countEdges)
         if verbose:
             self._timeUpdate()
 
@@ -1287,6 +1620,7 @@ class Query(object):
     'results': 'Blah',
     'metadata': 'Blah',
     'pattern': 'Blah',
+    'params': 'The Cypher parameters for the filter values in the pattern.',
     'nodes': 'Blah'
     }
     
@@ -1294,20 +1628,24 @@ class Query(object):
         self.db = db
         self._constructCallbacks = {}
         self.start = self.pattern = None
+        self._patternArgs = None
+        self.params = {}
         self.startNodes = []
         self.match = []
         self.optionalMatch = []
         self.where = []
+        self._whereFilters = set()  # the Filter objects in self.where
         self.limitReturnToWhere = False
         #self.orders = []
         self.returns = []
+        self._returnSet = set()  # the properties in self.returns
         self.returnStr = ''
         self.nodes = set()
         self.limit = ''
         self.phrases = {}
-        self._usedNames = []
+        self._usedNames = set()
+        self._classAttributes = {}  # music21 class -> names of its class attributes
         self._defaultCallbacks()
-        self._inspectMusic21ExpressionsArticulations()
         
     def setStartNode(self, node=None, nodeType=None, name=None, nodeId=None, noIndex=False, overWrite=False):
         '''Sets a starting :class:`Node` for the Query, and returns that node. 
@@ -1344,6 +1682,7 @@ class Query(object):
         elif noIndex:
             self.match = ['(%s)' % node.name]
             self.where = []
+            self._whereFilters.clear()
             self.addComparisonFilter(node.type, '=', nodeType)
         else:
             self.start = 'start %s=node:node_auto_index("type:%s")\n' % (node.name, node.nodeType)
@@ -1381,8 +1720,8 @@ class Query(object):
 
         if not pattern:
             pattern = self._assemblePattern(limit=limit, omitStart=omitStart)
-        #params = { 'minRow': minRow, 'maxResults': limit }
-        r = Results(pattern)
+        params = self.params if pattern is self.pattern else None
+        r = Results(pattern, params, self.db)
         r.start()
         return r
         #results, columns = _cypherQuery(self.db.graph_db, pattern, params)
@@ -1528,10 +1867,20 @@ class Query(object):
         and scores, unless we want to return information about them or add filters to them.
         In this case the Note object by itself would be enough 
         (using just the :meth:`setStartNode` method).
+        
+        Adding the same filter again has no effect, even if a value is a list:
+
+        >>> print q.addComparisonFilter(n1.pitch, 'IN', ['C4', 'E4'])
+        Note1.pitch IN ['C4', 'E4']
+        >>> print q.addComparisonFilter(n1.pitch, 'IN', ['C4', 'E4'])
+        Note1.pitch IN ['C4', 'E4']
+        >>> len(q.where)
+        2
         '''
         self.pattern = None
         filt = Filter(self, pre, operator, post)
-        if filt not in self.where:
+        if filt not in self._whereFilters:
+            self._whereFilters.add(filt)
             self.where.append(filt)
         return filt
         
@@ -1559,6 +1908,23 @@ class Query(object):
         of `NoteSimultaneousWithNote` relationships:
         
         >>> f = q.addComparisonFilter(nSWN.simpleHarmonicInterval, '=', 7)        
+        
+        Cypher filters are used as written, while the values in comparison filters
+        are passed to the server as parameters:
+        
+        >>> q = Query(db)
+        >>> n = q.setStartNode(nodeType='Note', name='Note1')
+        >>> q.addCypherFilter('Note1.midi % 12 = 7')
+        >>> f = q.addComparisonFilter(n.midi, '<', 60)
+        >>> print q._assemblePattern()
+        start Note1=node:node_auto_index("type:Note")
+        where
+        Note1.midi % 12 = 7
+        and Note1.midi < {p0}
+        return *
+        LIMIT 100;
+        >>> print q.params
+        {'p0': 60}
         '''
         self.pattern = None
         self.where.append(text)
@@ -1587,7 +1953,9 @@ class Query(object):
         '''
         self.pattern = None
         for p in props:
-            self.returns.append(p)
+            if p not in self._returnSet:
+                self._returnSet.add(p)
+                self.returns.append(p)
 
     def music21Score(self, resultList, metadata=None):
         '''
@@ -1611,20 +1979,29 @@ class Query(object):
         self._addHierarchicalNodes(result, metadata, True)
         result = self.getResultProperties(result)
         nodes = {}
+        nodesByType = {}
         relations = []
         for itemTuple in result:
             if isinstance(itemTuple[0], py2neo.neo4j.Node):
-                if _id(itemTuple[0]) not in nodes:
-                    nodes[_id(itemTuple[0])] = itemTuple
+                itemId = _id(itemTuple[0])
+                if itemId not in nodes:
+                    nodes[itemId] = itemTuple
+                    nodesByType.setdefault(itemTuple[1]['type'], []).append(itemTuple)
             else:
                 relations.append(itemTuple)
         start = time.clock()
         score = music21.stream.Score()
-        scoreNodeId = [x for x in nodes if nodes[x][1]['type'] == 'Score'][0]
+        scoreNodeId = _id(nodesByType['Score'][0][0])
         self._addMusic21Properties(score, nodes[scoreNodeId][1])
-        measures = [x for x in nodes.values() if x[1]['type'] == 'Measure']
-        self.scoreOffset = sorted([float(x[1]['offset']) for x in measures])[0]
-        self._addHierarchicalMusic21Data(score, scoreNodeId, nodes, relations)
+        measures = nodesByType['Measure']
+        self.scoreOffset = min(float(x[1]['offset']) for x in measures)
+        # Index the relationships by the node they point to, in ID order.
+        relatesByParent = {}
+        for r in relations:
+            relatesByParent.setdefault(_id(r[0].end_node), []).append(r)
+        for relates in relatesByParent.itervalues():
+            relates.sort(key=lambda r: _id(r[0]))
+        self._addHierarchicalMusic21Data(score, scoreNodeId, nodes, relatesByParent)
         sys.stdout.flush()
         return score
 
@@ -1686,8 +2063,7 @@ class Query(object):
         def addSignaturesAndClefs(self, measureDict, measure, part, r):
             firstMeasure = (_convertFromString(measureDict['offset']) == self.scoreOffset)
             if 'clef' in measureDict and (measureDict['clefIsNew'] == 'True' or firstMeasure):
-                classLookup = self._listMusic21Classes()
-                clef = classLookup[measureDict['clef']]()
+                clef = _music21Class(measureDict['clef'])()
                 measure.insert(clef)
             if 'keySignatureSharps' in measureDict and (measureDict['keyIsNew'] == 'True' or firstMeasure):
                 sharps = _convertFromString(measureDict['keySignatureSharps'])
@@ -1707,8 +2083,7 @@ class Query(object):
         
         # MidmeasureClefInMeasure
         def addMidmeasureClef(self, clefDict, clef, measure, r):
-            classLookup = self._listMusic21Classes()
-            clef = classLookup[clefDict['name']]()
+            clef = _music21Class(clefDict['name'])()
             measure.insert(clef)
             return clef
         self.setObjectCallback('MidmeasureClefInMeasure', addMidmeasureClef)
@@ -1716,9 +2091,8 @@ class Query(object):
         # NoteInMeasure
         def setPitchAndDuration(self, noteDict, note, measure, r):
             # .nameWithOctave is not read/write in music21 1.0.
-            import re
             if ('pitch' in noteDict):
-                name = re.sub('[0-9]*', '', noteDict['pitch'])
+                name = _OCTAVE_RE.sub('', noteDict['pitch'])
                 note.midi = int(noteDict['midi'])
                 note.name = name
                 del noteDict['pitch']
@@ -1742,10 +2116,9 @@ class Query(object):
             
         # ArticulationInNote, ExpressionInNote
         def replaceWithSpecificClass(self, classDict, classObj, noteObj, r):
-            classLookup = self._listMusic21Classes()
-            childType = classDict['name']
-            obj = classLookup[childType]()
-            classAttribute = obj.__module__[8:] 
+            objClass = _music21Class(classDict['name'])
+            obj = objClass()
+            classAttribute = objClass.__module__[8:] 
             getattr(noteObj, classAttribute).append(obj)
             return obj
         self.setObjectCallback('ArticulationInNote', replaceWithSpecificClass)
@@ -1762,10 +2135,9 @@ class Query(object):
         
         # spannerTo
         def replaceWithSpecificSpanner(self, noteDict, note, otherNote, r):
-            classLookup = self._listMusic21Classes()
             spanDict = r[1]
             spanType = spanDict.pop('name')
-            span = classLookup[spanType]()
+            span = _music21Class(spanType)()
             start = self.nodeLookup[_id(r[0].start_node)]
             end = self.nodeLookup[_id(r[0].end_node)]
             span.addComponents(start, end)
@@ -1789,38 +2161,25 @@ class Query(object):
         self.setObjectCallback('default', defaultChild)
 
     def _listMusic21Classes(self):
-        if hasattr(self, 'classLookup'):
-            return self.classLookup
-        import pkgutil
-        import inspect
-        self.classLookup = {}
-        for importer, modname, ispkg in pkgutil.iter_modules(music21.__path__):
-            modname = 'music21.' + modname
-            if modname not in sys.modules:
-                continue
-            mod = sys.modules[modname]
-            for c in inspect.getmembers(mod, inspect.isclass):
-                self.classLookup[c[0]] = getattr(mod, c[0])
-        return self.classLookup
-
-    def _inspectMusic21ExpressionsArticulations(self):
-        import inspect
-        self.m21_classes = {}
-        # inspect music21 modules:
-        for module in (music21.expressions, music21.articulations):
-            mName = module.__name__
-            self.m21_classes[mName] = {}
-            classes = inspect.getmembers(module, inspect.isclass)
-            for cName, ref in classes:
-                self.m21_classes[mName][cName] = ref
+        return _getMusic21Classes()
 
     def _assemblePattern(self, limit=None, distinct=False, omitStart=False):
-        if self.pattern:
+        # The pattern is reset to None whenever the query changes, 
+        # and is only reused if it was built with the same arguments.
+        patternArgs = (limit, distinct, omitStart)
+        if self.pattern and self._patternArgs == patternArgs:
             return self.pattern
         startStr = ''
+        params = {}
         #if not omitStart:
         if self.startNodes:
-            startStr = 'start ' + ', '.join(['%s=node(%d)' % (n.name, n.id) for n in self.startNodes]) + '\n'
+            # Node IDs are passed as parameters too; a parameter can hold one ID or a list.
+            starts = []
+            for n in self.startNodes:
+                key = 'p%d' % len(params)
+                params[key] = list(n.id) if isinstance(n.id, (list, tuple)) else n.id
+                starts.append('%s=node({%s})' % (n.name, key))
+            startStr = 'start ' + ', '.join(starts) + '\n'
         else:
             startStr = self.start
         if startStr == None:
@@ -1830,15 +2189,19 @@ class Query(object):
         if self.match:
             matchStr = 'match\n' + ',\n'.join([str(x) for x in self.match]) + '\n'
         if self.where:
-            whereStr = 'where\n' + '\nand '.join([str(x) for x in self.where]) + '\n'
+            # Filters added with addCypherFilter are plain text.
+            whereStr = 'where\n' + '\nand '.join([x if isinstance(x, basestring) else x._cypher(params) 
+                                                   for x in self.where]) + '\n'
         if self.optionalMatch:
             optMatchStr = '\n'.join(['optional match\n' + str(x) for x in self.optionalMatch]) + '\n'            
         props = []
-        if self.returns:
-            props = self.returns[:]
-        else:
-            props.append('*')
-        props = [str(x) for x in set(props)]
+        for prop in self.returns:
+            # Returns can also be given as text, so drop duplicates by their text.
+            text = str(prop)
+            if text not in props:
+                props.append(text)
+        if not props:
+            props = ['*']
         distinctStr = ''
         limitStr = ''
         if limit:
@@ -1847,6 +2210,8 @@ class Query(object):
             limitStr = 'LIMIT 100'
         returnStr = 'return ' + distinctStr + ', '.join(props) + '\n'
         self.pattern = startStr + matchStr + whereStr + optMatchStr + returnStr + limitStr + ';'
+        self._patternArgs = patternArgs
+        self.params = params
         return self.pattern
 
     def _addHierarchicalNodes(self, results, metadata, buildFullScore):
@@ -1857,7 +2222,8 @@ class Query(object):
         '''
         nodes = {}
         relations = {}
-        self._filterNodesAndRelationships(results, nodes, relations)
+        nodesByType = {}
+        self._filterNodesAndRelationships(results, nodes, relations, nodesByType)
         
         # For each note in the result, fill in the structural nodes above it.
         q = Query(self.db)
@@ -1869,69 +2235,89 @@ class Query(object):
         q.addRelationship(relationType='InstrumentInPart', end=inPart.end, optional=True)
         q.addRelationship(relationType='MetadataInScore', end=inScore.end, optional=True)
         q.addRelationship(relationType='StaffGroupInScore', end=inScore.end, optional=True)
+        noteIds = []
         for i in range(len(results)):
             node = results[i]
             meta = _getPy2neoMetadata(node)
             if meta['type'] != 'Note': continue
             node.queryNode = True
             node.queryName = metadata[i]
-            n.id = _id(node)
+            noteIds.append(_id(node))
+        if noteIds:
+            # Fetch the hierarchies of all the notes at once, keeping the first row for each note.
+            n.id = noteIds
             q.setStartNode(n, overWrite=True)
-            subresults = q.results().next()[0]
-            self._filterNodesAndRelationships(subresults.values, nodes, relations)
+            pending = set(noteIds)
+            for subresults in q.results(limit=100 * len(noteIds)):
+                noteId = next((_id(x) for x in subresults.values 
+                               if isinstance(x, py2neo.neo4j.Node) and _id(x) in pending), None)
+                if noteId is None:
+                    continue
+                pending.discard(noteId)
+                self._filterNodesAndRelationships(subresults.values, nodes, relations, nodesByType)
+            # The LIMIT is unordered, so other notes' rows may have crowded some notes out.
+            for noteId in [x for x in noteIds if x in pending]:
+                n.id = noteId
+                q.setStartNode(n, overWrite=True)
+                for subresults in q.results(limit=1):
+                    self._filterNodesAndRelationships(subresults.values, nodes, relations, nodesByType)
 
         if (buildFullScore):
             # Fill in the other notes in the measures.
-            measures = [x for x in nodes.values() if _getPy2neoMetadata(x)['type'] == 'Measure']
-            for m in measures:
-                self._addChildren(m, 'NoteInMeasure', nodes, relations)
+            measures = nodesByType.get('Measure', [])[:]
+            self._addChildren(measures, 'NoteInMeasure', nodes, relations, nodesByType=nodesByType)
     
             # Add one more layer of objects below the existing ones.
-            nodeList = nodes.values()
-            for node in nodeList:
-                nType = _getPy2neoMetadata(node)['type']
-                if nType in ('Score', 'Part'):
-                    continue
-                self._addChildren(node, None, nodes, relations, structural=True)
+            nodeList = [node for nType, typeNodes in nodesByType.items()
+                        if nType not in ('Score', 'Part') for node in typeNodes]
+            self._addChildren(nodeList, None, nodes, relations, structural=True)
             
         results[:] = nodes.values() + relations.values()
 
-    def _filterNodesAndRelationships(self, results, nodes, relations):
+    def _filterNodesAndRelationships(self, results, nodes, relations, nodesByType=None):
         ''' Nodes and Relations must be hashed separately to avoid ID number clashes.
+        New nodes are also added to the `nodesByType` lists, if given.
         '''
         flatLists = [v for k in [x for x in results if isinstance(x, list)] for v in k]
         results = [x for x in results if not isinstance(x, list)]
         results.extend(flatLists)
         for item in results:
             if isinstance(item, py2neo.neo4j.Node):
-                if _id(item) not in nodes:
-                    nodes[_id(item)] = item
+                itemId = _id(item)
+                if itemId not in nodes:
+                    nodes[itemId] = item
+                    if nodesByType is not None:
+                        nodeType = _getPy2neoMetadata(item)['type']
+                        nodesByType.setdefault(nodeType, []).append(item)
             elif isinstance(item, py2neo.neo4j.Relationship):
                 relations[_id(item)] = item
     
-    def _addChildren(self, node, rType, nodes, relations, structural=False):
-        ''' Add all the children of this node that are connected by the specified Relationship type.
+    def _addChildren(self, parents, rType, nodes, relations, structural=False, nodesByType=None, 
+                     batchSize=100):
+        ''' Add all the children of these nodes that are connected by the specified Relationship type.
+        The parents are queried `batchSize` at a time rather than one by one.
         '''
         q = Query(self.db)
-        n = Node(q, nodeId=_id(node))
-        q.setStartNode(n)
+        n = Node(q)
         r = Relationship(q, relationType=rType, end=n)
         if structural:
             r.properties = {'structural': True}
         q.addRelationship(r)
-        rGen = q.results(limit=500)
-        subresults = rGen.fetch_all()
-        for result in subresults:
-            self._filterNodesAndRelationships(result.values, nodes, relations)
+        for idx in range(0, len(parents), batchSize):
+            batch = parents[idx:idx + batchSize]
+            n.id = [_id(x) for x in batch]
+            q.setStartNode(n, overWrite=True)
+            rGen = q.results(limit=500 * batchSize)
+            for result in rGen:
+                self._filterNodesAndRelationships(result.values, nodes, relations, nodesByType)
                     
-    def _addHierarchicalMusic21Data(self, parent, parentId, nodes, relates):
-        # Some bits of the music21-to-MusicXML conversion process are sensitive to order.
-        relatesToNode = sorted([x for x in relates if _id(x[0].end_node) == parentId],
-                               key=lambda r: _id(r[0]))
-        for r in relatesToNode:
+    def _addHierarchicalMusic21Data(self, parent, parentId, nodes, relatesByParent):
+        # Some bits of the music21-to-MusicXML conversion process are sensitive to order,
+        # so the relationships to each parent are sorted by ID.
+        parentSuffix = 'In' + parent.__class__.__name__
+        for r in relatesByParent.get(parentId, ()):
             rType = r[0]['type']
-            parentType = parent.__class__.__name__
-            if not (rType.endswith('In' + parentType) or rType in ('spannerTo')):
+            if not (rType.endswith(parentSuffix) or rType == 'spannerTo'):
                 continue
             childId = _id(r[0].start_node)
             childDict = nodes[childId][1]
@@ -1943,7 +2329,7 @@ class Query(object):
                 child.editorial.color = 'red'
                 #child.queryName = queryName
             self.nodeLookup[childId] = child
-            self._addHierarchicalMusic21Data(child, childId, nodes, relates)
+            self._addHierarchicalMusic21Data(child, childId, nodes, relatesByParent)
 
     def _addMusic21Child(self, childDict, parent, r):
         classLookup = self._listMusic21Classes()
@@ -1952,26 +2338,33 @@ class Query(object):
             child = classLookup[childType]()
         else:
             child = None
-        rType = r[0]['type']
-        if rType not in self._constructCallbacks:
-            rType = 'default'
-        child = self._constructCallbacks[rType](self, childDict, child, parent, r)
+        callback = self._constructCallbacks.get(r[0]['type'])
+        if callback is None:
+            callback = self._constructCallbacks['default']
+        child = callback(self, childDict, child, parent, r)
         if child == None:
             return None
         self._addMusic21Properties(child, childDict)
         return child
 
     def _addMusic21Properties(self, obj, objDict):
+        # Only class attributes (such as properties) need setattr; everything else
+        # can go straight into the instance dict. Remember which is which per class.
+        cls = obj.__class__
+        classAttributes = self._classAttributes.get(cls)
+        if classAttributes is None:
+            classAttributes = self._classAttributes[cls] = frozenset(dir(cls))
+        instanceDict = obj.__dict__
         for key, val in objDict.iteritems():
             if key == 'type':
                 continue
             if key.startswith('m21_'):
                 key = key[4:]
             val = _convertFromString(val)
-            if hasattr(obj, key):
+            if key in classAttributes:
                 setattr(obj, key, val)
             else:
-                obj.__dict__[key] = val
+                instanceDict[key] = val
 
 #-------------------------------------------------------------------------------
 class Entity(object):
@@ -1993,16 +2386,17 @@ class Entity(object):
     
     def __eq__(self, other):
         return (isinstance(other, self.__class__)
-            and self.__dict__ == other.__dict__)
+            and self._key() == other._key())
 
     def __ne__(self, other):
         return not self.__eq__(other)
     
-    def __key(self):
-        return tuple(self.__dict__.values())
+    def _key(self):
+        # Names are unique within a query.
+        return (self.__class__, self.query, self.name)
     
     def __hash__(self):
-        return hash(self.__key())
+        return hash(self._key())
 
     def _addName(self, name):
         while not name:
@@ -2015,7 +2409,7 @@ class Entity(object):
         if name in self.query._usedNames:
             raise ValueError('The name "%s" is already being used.' % name)
         self.name = name
-        self.query._usedNames.append(name)
+        self.query._usedNames.add(name)
 
 class Node(Entity):
     '''An object that represents a database node in a query.
@@ -2040,7 +2434,7 @@ class Node(Entity):
     
     _DOC_ATTR = {
     'nodeType': 'The type of database node this object represents.',
-    'id': 'The numeric ID of this node in the database (default=None).'
+    'id': 'The numeric ID of this node in the database (default=None). A list of IDs will match any of them in a start node.'
     }
 
     def __init__(self, query, nodeType=None, name=None, nodeId=None):
@@ -2111,7 +2505,7 @@ class Relationship(Entity):
             rType = ''
             delimiter = ''
         if (self.properties):
-            props = ' {' + ','.join(['%s:%s' % (k, repr(v)) for k, v in self.properties.items()]) + '}'
+            props = ' {' + ','.join(['%s:%s' % (k, repr(v)) for k, v in self.properties.iteritems()]) + '}'
         return '(%s)-[%s%s%s%s%s]->(%s)' % (self.start, self.name, delimiter, rType, distance, props, self.end)
 
 class Property(Entity):
@@ -2127,13 +2521,21 @@ class Property(Entity):
         Entity.__init__(self, query)
         self.parent = parent
         self.name = name
+        self._repr = None
         
     def __repr__(self):
-        if (self.name == 'ID'):
-            return 'ID(%s)' % self.parent.name
-        elif (self.name == 'type' and isinstance(self.parent, Relationship)):
-            return 'TYPE(%s)' % self.parent.name
-        return '%s.%s' % (self.parent.name, self.name)
+        # Properties are formatted often while a query is assembled, so keep the text.
+        if self._repr is None:
+            if (self.name == 'ID'):
+                self._repr = 'ID(%s)' % self.parent.name
+            elif (self.name == 'type' and isinstance(self.parent, Relationship)):
+                self._repr = 'TYPE(%s)' % self.parent.name
+            else:
+                self._repr = '%s.%s' % (self.parent.name, self.name)
+        return self._repr
+    
+    def _key(self):
+        return (self.__class__, self.query, self.parent.name, self.name)
     
     def __getattr__(self):
         raise AttributeError
@@ -2165,12 +2567,32 @@ class Filter(Entity):
     def __repr__(self):
         operands = []
         for operand in (self.pre, self.post):
-            if isinstance(operand, (unicode, str, bool)):
-                text = '"%s"' % operand
-                operands.append(text)
+            if isinstance(operand, _TEXT_TYPES):
+                operands.append('"%s"' % operand)
             else:
                 operands.append(str(operand))
         return '%s %s %s' % (operands[0], self.operator, operands[1])
+
+    def _cypher(self, params):
+        ''' Returns the filter as Cypher text, with any literal values replaced by 
+        parameters that are added to the `params` dict. This way queries that differ 
+        only in their values share the same text (and the same cached query plan).
+        '''
+        operands = []
+        for operand in (self.pre, self.post):
+            if isinstance(operand, Entity):
+                operands.append(str(operand))
+                continue
+            if isinstance(operand, bool):
+                # Booleans like 'sameOffset' are stored as text in the database.
+                operand = str(operand)
+            key = 'p%d' % len(params)
+            params[key] = operand
+            operands.append('{%s}' % key)
+        return '%s %s %s' % (operands[0], self.operator, operands[1])
+    
+    def _key(self):
+        return (self.__class__, self.query, _frozen(self.pre), self.operator, _frozen(self.post))
     
     def __getattr__(self):
         raise AttributeError
@@ -2180,7 +2602,7 @@ class Moment(music21.base.Music21Object):
     :class:`~music21.voiceLeading.VerticalSlice` in that it contains every
     :class:`~music21.note.Note` that occurs at a given offset in a
     :class:`~music21.stream.Score`. (Notes are stored as references
-    to the original objects in :class:`~weakref.WeakSet` objects.) A Moment acts like a
+    to the original objects in sets.) A Moment acts like a
     :class:`~music21.spanner.Spanner` placed at the end of a Score.
     
     A Moment can serve the same function as a VerticalSlice or a call 
@@ -2201,44 +2623,59 @@ class Moment(music21.base.Music21Object):
     _DOC_ORDER = ['getComponents', 'addComponents']
     
     _DOC_ATTR = {
-    'sameOffset': 'A :class:`weakref.WeakSet` referring to all the Notes starting at the Moment.',
-    'simultaneous': 'A :class:`weakref.WeakSet` referring to any Notes that started before the Moment but hold over into it.'
+    'sameOffset': 'A set of all the Notes starting at the Moment.',
+    'simultaneous': 'A set of any Notes that started before the Moment but hold over into it.'
     }
         
-    def __init__(self, components=None, sameOffset=None, *arguments):
+    def __init__(self, components=None, sameOffset=None, *arguments, **keywords):
         music21.base.Music21Object.__init__(self)
-        self.sameOffset = weakref.WeakSet()
-        self.simultaneous = weakref.WeakSet()
+        self.sameOffset = set()
+        self.simultaneous = set()
         if components:
-            self.addComponents(components, sameOffset, *arguments)
+            self.addComponents(components, sameOffset, *arguments, **keywords)
         
     def getComponents(self):
-        '''Returns the contents of the object as a :class:`weakref.WeakSet`. This is simply the
+        '''Returns the contents of the object as a new set. This is simply the
         union of two of the object's attributes: `sameOffset` and `simultaneous`.
         '''
         return self.sameOffset | self.simultaneous
     
-    def addComponents(self, components, sameOffset=None, *arguments):
+    def addComponents(self, components, sameOffset=None, *arguments, **keywords):
         '''Adds a :class:`~music21.note.Note` object (or a list of Notes) to the
         object. If a Note has the same offset as this object, a reference to it
         is added to `sameOffset`. Otherwise a reference is added to `simultaneous`.
+        
+        Unless `sameOffset` is given, each Note's offset in the score is found
+        through its Measure. When adding many Notes, an `offsets` keyword argument
+        can be passed instead: a dict of the Notes' score offsets, indexed by `id(note)`.
         '''
         if not music21.common.isListLike(components):
-            components = [components]
-        components += arguments
-        for c in components:
+            components = (components,)
+        notes = list(itertools.chain(components, arguments))
+        for c in notes:
             if not isinstance(c, music21.note.Note):
                 raise ValueError('cannot add a non-Note object to a Moment')
-            if sameOffset == True:
-                self.sameOffset.add(c)
-            elif sameOffset == False:
-                self.sameOffset.add(c)
+        if sameOffset is True:
+            self.sameOffset.update(notes)
+            return
+        if sameOffset is False:
+            self.simultaneous.update(notes)
+            return
+        offsets = keywords.get('offsets')
+        momentTicks = _ticks(self.offset)
+        starting = []
+        held = []
+        for c in notes:
+            if offsets is not None and id(c) in offsets:
+                offset = offsets[id(c)]
             else:
                 offset = c.getContextByClass('Measure').offset + c.offset
-                if offset == self.offset:
-                    self.sameOffset.add(c)
-                else:
-                    self.simultaneous.add(c)        
+            if _ticks(offset) == momentTicks:
+                starting.append(c)
+            else:
+                held.append(c)
+        self.sameOffset.update(starting)
+        self.simultaneous.update(held)
 
 class Test(unittest.TestCase):
 
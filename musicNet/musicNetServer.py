@@ -498,8 +498,8 @@ def prepareQuery():
     else:
         print pattern ###
         ipAddr = flask.request.remote_addr or "None"
-        token = hash(ipAddr + pattern)
-        rGen = music21.musicNet.Results(pattern)
+        token = hash(ipAddr + pattern + repr(sorted(q.params.items())))
+        rGen = music21.musicNet.Results(pattern, q.params)
         rGen.start()
         app.rGens[token] = rGen
         app.tokens[token] = [pattern, columns, previews, time.time()]